@@ -8,6 +8,7 @@ import hashlib
 import json
 import logging
 import os
+import re
 import subprocess
 
 import yaml
@@ -20,58 +21,113 @@ from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from exceptions import ProcessExecutionError
 from utils.retry import retry
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: nocover
+    from yaml import SafeLoader
+
 logger = logging.getLogger(__name__)
 
+CONTRACT_URL_RE = re.compile(r"^contract_url:.*$", re.MULTILINE)
+TOKEN_HASH_PREFIX = "b2:"
+VERSION_ID_RE = re.compile(r'^VERSION_ID="?([0-9.]+)"?$', re.MULTILINE)
+
+
+def supports_no_update():
+    """Return whether add-apt-repository accepts --no-update, which it does from 18.04."""
+    with open("/etc/os-release") as f:
+        match = VERSION_ID_RE.search(f.read())
+    if not match:
+        return False
+    return tuple(int(part) for part in match.group(1).split(".")) >= (18, 4)
+
 
-def install_ppa(ppa, env):
-    """Install specified ppa."""
-    subprocess.check_call(["add-apt-repository", "--yes", ppa], env=env)
+def install_ppa(ppa, env, update=True):
+    """Install specified ppa, passing --no-update when update is False."""
+    cmd = ["add-apt-repository", "--yes"]
+    if not update:
+        cmd.append("--no-update")
+    subprocess.check_call(cmd + [ppa], env=env)
 
 
-def remove_ppa(ppa, env):
-    """Remove specified ppa."""
-    subprocess.check_call(["add-apt-repository", "--remove", "--yes", ppa], env=env)
+def remove_ppa(ppa, env, update=True):
+    """Remove specified ppa, passing --no-update when update is False."""
+    cmd = ["add-apt-repository", "--remove", "--yes"]
+    if not update:
+        cmd.append("--no-update")
+    subprocess.check_call(cmd + [ppa], env=env)
+
+
+def is_package_installed(package):
+    """Return whether the package is installed on the machine."""
+    try:
+        apt.DebianPackage.from_installed_package(package)
+    except apt.PackageNotFoundError:
+        return False
+    return True
 
 
 def update_configuration(contract_url):
     """Write the contract_url to the uaclient configuration file."""
+    # A JSON string is also a valid YAML double-quoted scalar
+    line = "contract_url: {}".format(json.dumps(contract_url))
     with open("/etc/ubuntu-advantage/uaclient.conf", "r+") as f:
-        client_config = yaml.safe_load(f)
-        client_config["contract_url"] = contract_url
+        client_config = f.read()
+        match = CONTRACT_URL_RE.search(client_config)
+        if match:
+            try:
+                current_url = yaml.load(match.group(0), Loader=SafeLoader)["contract_url"]
+            except yaml.YAMLError:
+                logger.warning("Rewriting unparsable line in uaclient.conf: %s", match.group(0))
+                current_url = None
+            if current_url == contract_url:
+                logger.debug("uaclient.conf already has contract_url %s", contract_url)
+                return
+            start, end = match.span()
+            client_config = client_config[:start] + line + client_config[end:]
+        else:
+            if client_config and not client_config.endswith("\n"):
+                client_config += "\n"
+            client_config += line + "\n"
         f.seek(0)
-        yaml.dump(client_config, f)
+        f.write(client_config)
         f.truncate()
 
 
+def hash_token(token):
+    """Return the digest of the token used to detect token changes."""
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=16).hexdigest()
+    return TOKEN_HASH_PREFIX + digest
+
+
 def detach_subscription():
     """Detach from any ubuntu-advantage subscription."""
     subprocess.check_call(["ubuntu-advantage", "detach", "--assume-yes"])
 
 
+def run_command(cmd):
+    """Run the command and return its result, raising ProcessExecutionError on failure."""
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        logger.error(
+            "Error running %s. stderr %s\nstdout: %s", cmd[1], result.stderr, result.stdout
+        )
+        raise ProcessExecutionError(result.args, result.returncode, result.stdout, result.stderr)
+    return result
+
+
 @retry(ProcessExecutionError)
 def attach_subscription(token):
     """Attach an ubuntu-advantage subscription using the specified token."""
-    result = subprocess.run(["ubuntu-advantage", "attach", token], capture_output=True, text=True)
-    if result.returncode != 0:
-        logger.error("Error running attach. stderr %s\nstdout: %s", result.stderr, result.stdout)
-        raise ProcessExecutionError(result.args, result.returncode, result.stdout, result.stderr)
+    result = run_command(["ubuntu-advantage", "attach", token])
     return result.returncode, result.stderr
 
 
 @retry(ProcessExecutionError)
 def get_status_output():
     """Return the parsed output from ubuntu-advantage status."""
-    result = subprocess.run(
-        ["ubuntu-advantage", "status", "--all", "--format", "json"], capture_output=True, text=True
-    )
-    if result.returncode != 0:
-        logger.error("Error running attach. stderr %s\nstdout: %s", result.stderr, result.stdout)
-        raise ProcessExecutionError(result.args, result.returncode, result.stdout, result.stderr)
-    output = result.stdout
-    # handle different return type from xenial
-    if isinstance(output, bytes):
-        output = output.decode("utf-8")
-    return json.loads(output)
+    result = run_command(["ubuntu-advantage", "status", "--format", "json"])
+    return json.loads(result.stdout)
 
 
 class UbuntuAdvantageCharm(CharmBase):
@@ -83,14 +139,23 @@ class UbuntuAdvantageCharm(CharmBase):
         super().__init__(*args)
         self._setup_proxy_env()
         self._state.set_default(
-            contract_url=None, hashed_token=None, package_needs_installing=True, ppa=None
+            apt_cache_stale=False,
+            config_hash=None,
+            contract_url=None,
+            hashed_token=None,
+            package_needs_installing=True,
+            ppa=None,
+            proxy_http=None,
+            proxy_https=None,
         )
+        self._status_cache = None
 
         self.framework.observe(self.on.config_changed, self.config_changed)
+        self.framework.observe(self.on.upgrade_charm, self.upgrade_charm)
 
     def _setup_proxy_env(self):
         """Setup proxy variables from model."""
-        self.env = dict(os.environ)
+        self.env = os.environ.copy()
         self.env["http_proxy"] = self.config.get("override-http-proxy") or self.env.get(
             "JUJU_CHARM_HTTP_PROXY", ""
         )
@@ -106,39 +171,70 @@ class UbuntuAdvantageCharm(CharmBase):
         # operations (passed as an environment variable).
 
         # log proxy environment variables for debugging
-        for envvar, value in self.env.items():
-            if envvar.endswith("proxy".lower()):
-                logger.debug("Envvar '%s' => '%s'", envvar, value)
+        for envvar in ("http_proxy", "https_proxy", "no_proxy"):
+            logger.debug("Envvar '%s' => '%s'", envvar, self.env[envvar])
 
     def config_changed(self, event):
         """Install and configure ubuntu-advantage tools and attachment."""
         logger.info("Beginning config_changed")
-        self.unit.status = MaintenanceStatus("Configuring")
         self._setup_proxy_env()
+        config_hash = self._get_config_hash()
+        if config_hash == self._state.config_hash and isinstance(self.unit.status, ActiveStatus):
+            logger.info("Configuration unchanged, nothing to do")
+            return
+        self.unit.status = MaintenanceStatus("Configuring")
+        self._status_cache = None
         self._handle_ppa_state()
         self._handle_package_state()
         self._handle_subscription_state()
         if isinstance(self.unit.status, BlockedStatus):
             return
         self._handle_status_state()
+        self._state.config_hash = config_hash
         logger.info("Finished config_changed")
 
+    def upgrade_charm(self, event):
+        """Force the next config_changed to apply the configuration again."""
+        self._state.config_hash = None
+
+    def _get_config(self, key):
+        """Return the configured value for key without surrounding whitespace."""
+        return (self.config.get(key) or "").strip()
+
+    def _get_config_hash(self):
+        """Return a digest of all the inputs applied by config_changed."""
+        config = (
+            self._get_config("ppa"),
+            self._get_config("token"),
+            self._get_config("contract_url"),
+            self.env["http_proxy"],
+            self.env["https_proxy"],
+            self.env["no_proxy"],
+        )
+        return hashlib.blake2b(repr(config).encode("utf-8"), digest_size=16).hexdigest()
+
     def _handle_ppa_state(self):
-        """Handle installing/removing ppa based on configuration and state."""
-        ppa = self.config.get("ppa", "").strip()
+        """Handle installing/removing ppa based on configuration and state.
+
+        Where add-apt-repository allows it the apt cache is not refreshed here, a change of
+        ppa marks it as stale and the package install which follows refreshes it once.
+        """
+        ppa = self._get_config("ppa")
         old_ppa = self._state.ppa
 
         if old_ppa and old_ppa != ppa:
             logger.info("Removing previously installed ppa (%s)", old_ppa)
-            remove_ppa(old_ppa, self.env)
+            remove_ppa(old_ppa, self.env, update=not supports_no_update())
             self._state.ppa = None
+            self._state.apt_cache_stale = True
             # If ppa is changed, want to remove the previous version of the package for consistency
             self._state.package_needs_installing = True
 
         if ppa and ppa != old_ppa:
             logger.info("Installing ppa: %s", ppa)
-            install_ppa(ppa, self.env)
+            install_ppa(ppa, self.env, update=not supports_no_update())
             self._state.ppa = ppa
+            self._state.apt_cache_stale = True
             # If ppa is changed, want to force an install of the package for potential updates
             self._state.package_needs_installing = True
 
@@ -146,17 +242,21 @@ class UbuntuAdvantageCharm(CharmBase):
         """Install apt package if necessary."""
         if self._state.package_needs_installing:
             logger.info("Installing package ubuntu-advantage-tools")
-            apt.add_package("ubuntu-advantage-tools", update_cache=True)
+            update_cache = self._state.apt_cache_stale or not is_package_installed(
+                "ubuntu-advantage-tools"
+            )
+            apt.add_package("ubuntu-advantage-tools", update_cache=update_cache)
             self._state.package_needs_installing = False
+            self._state.apt_cache_stale = False
 
     def _handle_subscription_state(self):
         """Handle uaclient configuration and subscription attachment."""
-        token = self.config.get("token", "").strip()
-        hashed_token = hashlib.sha256(token.encode("utf-8")).hexdigest()
-        old_hashed_token = self._state.hashed_token
+        token = self._get_config("token")
+        hashed_token = hash_token(token)
+        old_hashed_token = self._get_old_hashed_token(token, hashed_token)
         token_changed = hashed_token != old_hashed_token
 
-        contract_url = self.config.get("contract_url", "").strip()
+        contract_url = self._get_config("contract_url")
         old_contract_url = self._state.contract_url
         config_changed = contract_url != old_contract_url
 
@@ -171,13 +271,14 @@ class UbuntuAdvantageCharm(CharmBase):
             self._state.contract_url = contract_url
 
         try:
-            status = get_status_output()
+            status = self._get_status()
         except ProcessExecutionError as e:
             self.unit_status = BlockedStatus(str(e))
             return
         if status["attached"] and (config_changed or token_changed):
             logger.info("Detaching ubuntu-advantage subscription")
             detach_subscription()
+            self._status_cache = None
             self._state.hashed_token = None
 
         if not token:
@@ -190,28 +291,51 @@ class UbuntuAdvantageCharm(CharmBase):
             except ProcessExecutionError as e:
                 self.unit.status = BlockedStatus(str(e))
                 return
+            finally:
+                self._status_cache = None
             self._state.hashed_token = hashed_token
 
+    def _get_old_hashed_token(self, token, hashed_token):
+        """Return the stored token digest, migrating the SHA-256 form of older revisions."""
+        old_hashed_token = self._state.hashed_token
+        if old_hashed_token and not old_hashed_token.startswith(TOKEN_HASH_PREFIX):
+            # Avoid a needless detach/attach on upgrade when the token is unchanged.
+            if old_hashed_token == hashlib.sha256(token.encode("utf-8")).hexdigest():
+                self._state.hashed_token = old_hashed_token = hashed_token
+        return old_hashed_token
+
     def _handle_status_state(self):
         """Parse status output to determine which services are active."""
-        status = get_status_output()
-        services = []
-        for service in status.get("services"):
-            if service.get("status") == "enabled":
-                services.append(service.get("name"))
-        message = "Attached (" + ",".join(services) + ")"
-        self.unit.status = ActiveStatus(message)
+        status = self._get_status()
+        services = [
+            service["name"]
+            for service in status.get("services") or ()
+            if service.get("status") == "enabled"
+        ]
+        self.unit.status = ActiveStatus(f"Attached ({','.join(services)})")
+
+    def _get_status(self):
+        """Return the ubuntu-advantage status, reusing the result within a hook."""
+        if self._status_cache is None:
+            self._status_cache = get_status_output()
+        return self._status_cache
 
     def _configure_ua_proxy(self):
         """Configure the proxy options for the ubuntu-advantage client."""
-        for config_key in ("http_proxy", "https_proxy"):
-            if self.env[config_key]:
+        for config_key, state_key in (
+            ("http_proxy", "proxy_http"),
+            ("https_proxy", "proxy_https"),
+        ):
+            value = self.env[config_key]
+            if value == getattr(self._state, state_key):
+                continue
+            if value:
                 subprocess.check_call(
                     [
                         "ubuntu-advantage",
                         "config",
                         "set",
-                        "{}={}".format(config_key, self.env[config_key]),
+                        "{}={}".format(config_key, value),
                     ]
                 )
             else:
@@ -223,6 +347,7 @@ class UbuntuAdvantageCharm(CharmBase):
                         config_key,
                     ]
                 )
+            setattr(self._state, state_key, value)
 
 
 if __name__ == "__main__":  # pragma: nocover
@@ -4,6 +4,7 @@
 """Utility functions for the Ubuntu Pro charm."""
 
 import logging
+import random
 import time
 from functools import wraps
 
@@ -13,20 +14,24 @@ RETRY_SLEEPS = [0.5, 1, 2]
 
 
 def retry(exception):
-    """Decorator to retry on exception multiple times with a sleep in between."""
+    """Decorator to retry on exception multiple times with a sleep in between.
+
+    The sleeps are jittered so that units retrying at the same time spread out.
+    """
 
     def wrapper(func):
         @wraps(func)
         def decorator(*args, **kwargs):
-            for idx, sleep_time in enumerate(RETRY_SLEEPS):
+            attempts = len(RETRY_SLEEPS)
+            for idx, sleep_time in enumerate(RETRY_SLEEPS, start=1):
                 try:
                     return func(*args, **kwargs)
                 except exception as e:
-                    remaining_retries = len(RETRY_SLEEPS) - idx - 1
+                    remaining_retries = attempts - idx
                     if remaining_retries == 0:
-                        raise e
+                        raise
                     logger.warning("%s: Retrying %d more times.", str(e), remaining_retries)
-                    time.sleep(sleep_time)
+                    time.sleep(sleep_time + random.uniform(0, sleep_time))
 
         return decorator
 
@@ -25,11 +25,9 @@ async def test_status(ops_test: OpsTest):
 
 async def test_attach_invalid_token(ops_test: OpsTest):
     charm = ops_test.model.applications["ubuntu-advantage"]
-    await charm.set_config({"token": ""})
-    await ops_test.model.wait_for_idle()
-
+    # The token is still unset after test_build_and_deploy, see test_status.
     await charm.set_config({"token": "new-token-2"})
-    await ops_test.model.wait_for_idle()
+    await ops_test.model.wait_for_idle(apps=["ubuntu-advantage"])
 
     unit = charm.units[0]
     assert unit.workload_status == BlockedStatus.name
@@ -1,16 +1,23 @@
 # Copyright 2024 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import io
 import json
 from subprocess import CalledProcessError
 from textwrap import dedent
 from unittest import TestCase
-from unittest.mock import MagicMock, call, mock_open, patch
+from unittest.mock import MagicMock, call, patch
 
+from charms.operator_libs_linux.v0.apt import PackageNotFoundError
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from ops.testing import Harness
 
-from charm import UbuntuAdvantageCharm
+from charm import (
+    UbuntuAdvantageCharm,
+    get_status_output,
+    supports_no_update,
+    update_configuration,
+)
 from exceptions import ProcessExecutionError
 
 STATUS_ATTACHED = json.dumps(
@@ -49,9 +56,20 @@ TEST_PROXY_URL = "http://squid.internal:3128"
 TEST_NO_PROXY = "127.0.0.1,localhost,::1"
 
 
-def _written(handle):
-    contents = "".join(["".join(a.args) for a in handle.write.call_args_list])
-    return contents
+class FakeFile(io.StringIO):
+    """In-memory file which records writes and keeps its contents once closed."""
+
+    contents = None
+
+    def __init__(self, initial_value):
+        super().__init__(initial_value)
+        self.write = MagicMock(wraps=self.write)
+        self.truncate = MagicMock(wraps=self.truncate)
+
+    def close(self):
+        if not self.closed:
+            self.contents = self.getvalue()
+        super().close()
 
 
 class TestCharm(TestCase):
@@ -64,15 +82,29 @@ class TestCharm(TestCase):
             "open": patch("builtins.open").start(),
             "environ": patch.dict("os.environ", clear=True).start(),
             "apt": patch("charm.apt").start(),
+            "supports_no_update": patch("charm.supports_no_update", return_value=True).start(),
         }
         self.mocks["call"].return_value = 0
         self.mocks["run"].return_value = MagicMock(returncode=0, stderr="")
-        mock_open(self.mocks["open"], read_data=DEFAULT_CLIENT_CONFIG)
+        self.mocks["apt"].PackageNotFoundError = PackageNotFoundError
+        self.mocks["apt"].DebianPackage.from_installed_package.side_effect = PackageNotFoundError(
+            "Package is not installed: ubuntu-advantage-tools"
+        )
+        self._fake_open(DEFAULT_CLIENT_CONFIG)
         self.harness = Harness(UbuntuAdvantageCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
         self.env = self.harness.charm.env
 
+    def _fake_open(self, read_data):
+        self.files = []
+
+        def _open(*args, **kwargs):
+            self.files.append(FakeFile(read_data))
+            return self.files[-1]
+
+        self.mocks["open"].side_effect = _open
+
     def test_config_defaults(self):
         self.assertEqual(
             self.harness.charm.config.get("contract_url"), "https://contracts.canonical.com"
@@ -87,7 +119,10 @@ class TestCharm(TestCase):
         self.mocks["check_call"].assert_has_calls(
             self._add_ua_proxy_setup_calls(
                 [
-                    call(["add-apt-repository", "--yes", "ppa:ua-client/stable"], env=self.env),
+                    call(
+                        ["add-apt-repository", "--yes", "--no-update", "ppa:ua-client/stable"],
+                        env=self.env,
+                    ),
                 ]
             )
         )
@@ -95,6 +130,28 @@ class TestCharm(TestCase):
         self.assertEqual(self.harness.charm._state.ppa, "ppa:ua-client/stable")
         self.assertFalse(self.harness.charm._state.package_needs_installing)
 
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_DETACHED))
+    def test_config_changed_ppa_new_xenial(self, m_get_status_output):
+        self.mocks["supports_no_update"].return_value = False
+        self.harness.update_config({"ppa": "ppa:ua-client/stable"})
+        self.mocks["check_call"].assert_has_calls(
+            self._add_ua_proxy_setup_calls(
+                [
+                    call(["add-apt-repository", "--yes", "ppa:ua-client/stable"], env=self.env),
+                ]
+            )
+        )
+        self._assert_apt_calls()
+
+    def test_supports_no_update(self):
+        self._fake_open('NAME="Ubuntu"\nVERSION_ID="16.04"\n')
+        self.assertFalse(supports_no_update())
+        self.mocks["open"].assert_called_with("/etc/os-release")
+        self._fake_open('NAME="Ubuntu"\nVERSION_ID="18.04"\n')
+        self.assertTrue(supports_no_update())
+        self._fake_open('NAME="Ubuntu"\nVERSION_ID="22.04"\n')
+        self.assertTrue(supports_no_update())
+
     @patch(
         "charm.get_status_output",
         side_effect=[json.loads(STATUS_DETACHED), json.loads(STATUS_DETACHED)],
@@ -105,7 +162,10 @@ class TestCharm(TestCase):
         self.mocks["check_call"].assert_has_calls(
             self._add_ua_proxy_setup_calls(
                 [
-                    call(["add-apt-repository", "--yes", "ppa:ua-client/stable"], env=self.env),
+                    call(
+                        ["add-apt-repository", "--yes", "--no-update", "ppa:ua-client/stable"],
+                        env=self.env,
+                    ),
                 ]
             )
         )
@@ -116,20 +176,29 @@ class TestCharm(TestCase):
         self.mocks["check_call"].reset_mock()
         self.mocks["apt"].reset_mock()
         self.harness.update_config({"ppa": "ppa:different-client/unstable"})
-        self.assertEqual(self.mocks["check_call"].call_count, 4)
+        self.assertEqual(self.mocks["check_call"].call_count, 2)
         self.mocks["check_call"].assert_has_calls(
-            self._add_ua_proxy_setup_calls(
-                [
-                    call(
-                        ["add-apt-repository", "--remove", "--yes", "ppa:ua-client/stable"],
-                        env=self.env,
-                    ),
-                    call(
-                        ["add-apt-repository", "--yes", "ppa:different-client/unstable"],
-                        env=self.env,
-                    ),
-                ]
-            )
+            [
+                call(
+                    [
+                        "add-apt-repository",
+                        "--remove",
+                        "--yes",
+                        "--no-update",
+                        "ppa:ua-client/stable",
+                    ],
+                    env=self.env,
+                ),
+                call(
+                    [
+                        "add-apt-repository",
+                        "--yes",
+                        "--no-update",
+                        "ppa:different-client/unstable",
+                    ],
+                    env=self.env,
+                ),
+            ]
         )
         self._assert_apt_calls()
         self.assertEqual(self.harness.charm._state.ppa, "ppa:different-client/unstable")
@@ -145,7 +214,10 @@ class TestCharm(TestCase):
         self.mocks["check_call"].assert_has_calls(
             self._add_ua_proxy_setup_calls(
                 [
-                    call(["add-apt-repository", "--yes", "ppa:ua-client/stable"], env=self.env),
+                    call(
+                        ["add-apt-repository", "--yes", "--no-update", "ppa:ua-client/stable"],
+                        env=self.env,
+                    ),
                 ]
             )
         )
@@ -155,8 +227,7 @@ class TestCharm(TestCase):
 
         self.mocks["check_call"].reset_mock()
         self.harness.update_config({"ppa": "ppa:ua-client/stable"})
-        self.assertEqual(self.mocks["check_call"].call_count, 2)
-        self.mocks["check_call"].assert_has_calls(self._add_ua_proxy_setup_calls([]))
+        self.mocks["check_call"].assert_not_called()
         self.assertEqual(self.harness.charm._state.ppa, "ppa:ua-client/stable")
         self.assertFalse(self.harness.charm._state.package_needs_installing)
 
@@ -170,7 +241,10 @@ class TestCharm(TestCase):
         self.mocks["check_call"].assert_has_calls(
             self._add_ua_proxy_setup_calls(
                 [
-                    call(["add-apt-repository", "--yes", "ppa:ua-client/stable"], env=self.env),
+                    call(
+                        ["add-apt-repository", "--yes", "--no-update", "ppa:ua-client/stable"],
+                        env=self.env,
+                    ),
                 ]
             )
         )
@@ -181,21 +255,57 @@ class TestCharm(TestCase):
         self.mocks["check_call"].reset_mock()
         self.mocks["apt"].reset_mock()
         self.harness.update_config({"ppa": ""})
-        self.assertEqual(self.mocks["check_call"].call_count, 3)
+        self.assertEqual(self.mocks["check_call"].call_count, 1)
         self.mocks["check_call"].assert_has_calls(
-            self._add_ua_proxy_setup_calls(
-                [
-                    call(
-                        ["add-apt-repository", "--remove", "--yes", "ppa:ua-client/stable"],
-                        env=self.env,
-                    ),
-                ]
-            )
+            [
+                call(
+                    [
+                        "add-apt-repository",
+                        "--remove",
+                        "--yes",
+                        "--no-update",
+                        "ppa:ua-client/stable",
+                    ],
+                    env=self.env,
+                ),
+            ]
         )
         self._assert_apt_calls()
         self.assertIsNone(self.harness.charm._state.ppa)
         self.assertFalse(self.harness.charm._state.package_needs_installing)
 
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_DETACHED))
+    def test_config_changed_ppa_package_failure(self, m_get_status_output):
+        self.mocks["apt"].add_package.side_effect = CalledProcessError(1, "apt-get")
+        with self.assertRaises(CalledProcessError):
+            self.harness.update_config({"ppa": "ppa:ua-client/stable"})
+        self.assertTrue(self.harness.charm._state.package_needs_installing)
+        self.assertTrue(self.harness.charm._state.apt_cache_stale)
+
+        # The apt cache is still refreshed when the hook is retried.
+        self.mocks["apt"].reset_mock(side_effect=True)
+        self.harness.update_config()
+        self._assert_apt_calls()
+        self.assertFalse(self.harness.charm._state.package_needs_installing)
+        self.assertFalse(self.harness.charm._state.apt_cache_stale)
+
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_DETACHED))
+    def test_config_changed_package_not_installed(self, m_get_status_output):
+        self.harness.update_config()
+        self.mocks["apt"].DebianPackage.from_installed_package.assert_called_once_with(
+            "ubuntu-advantage-tools"
+        )
+        self._assert_apt_calls()
+        self.assertFalse(self.harness.charm._state.package_needs_installing)
+        self.assertFalse(self.harness.charm._state.apt_cache_stale)
+
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_DETACHED))
+    def test_config_changed_package_installed(self, m_get_status_output):
+        self.mocks["apt"].DebianPackage.from_installed_package.side_effect = None
+        self.harness.update_config()
+        self._assert_apt_calls(update_cache=False)
+        self.assertFalse(self.harness.charm._state.package_needs_installing)
+
     def test_config_changed_ppa_apt_failure(self):
         self.mocks["check_call"].side_effect = CalledProcessError(
             "apt failure", "add-apt-repository"
@@ -214,22 +324,13 @@ class TestCharm(TestCase):
     def test_config_changed_token_unattached(self, m_get_status_output, m_attach_subscription):
         self.harness.update_config({"token": "test-token"})
         self.mocks["open"].assert_called_with("/etc/ubuntu-advantage/uaclient.conf", "r+")
-        handle = self.mocks["open"]()
-        expected = dedent(
-            """\
-            contract_url: https://contracts.canonical.com
-            data_dir: /var/lib/ubuntu-advantage
-            log_file: /var/log/ubuntu-advantage.log
-            log_level: debug
-        """
-        )
-        self.assertEqual(_written(handle), expected)
-        handle.truncate.assert_called_once()
+        self.files[-1].write.assert_not_called()
+        self.files[-1].truncate.assert_not_called()
         assert m_get_status_output.call_count == 2
         assert m_attach_subscription.call_count == 1
         self.assertEqual(
             self.harness.charm._state.hashed_token,
-            "4c5dc9b7708905f77f5e5d16316b5dfb425e68cb326dcd55a860e90a7707031e",
+            "b2:2d30173aca15d9b6b6a2d2475cb6c5b7",
         )
         self.assertEqual(
             self.harness.model.unit.status, ActiveStatus("Attached (esm-apps,esm-infra,livepatch)")
@@ -250,38 +351,25 @@ class TestCharm(TestCase):
         self.assertEqual(self.mocks["check_call"].call_count, 2)
         self._assert_apt_calls()
         self.mocks["open"].assert_called_with("/etc/ubuntu-advantage/uaclient.conf", "r+")
-        self._assert_apt_calls()
-        handle = self.mocks["open"]()
-        expected = dedent(
-            """\
-            contract_url: https://contracts.canonical.com
-            data_dir: /var/lib/ubuntu-advantage
-            log_file: /var/log/ubuntu-advantage.log
-            log_level: debug
-        """
-        )
-        self.assertEqual(_written(handle), expected)
-        handle.truncate.assert_called_once()
+        self.files[-1].write.assert_not_called()
+        self.files[-1].truncate.assert_not_called()
         assert m_get_status_output.call_count == 2
         assert m_attach_subscription.call_count == 1
         self.assertEqual(
             self.harness.charm._state.hashed_token,
-            "4c5dc9b7708905f77f5e5d16316b5dfb425e68cb326dcd55a860e90a7707031e",
+            "b2:2d30173aca15d9b6b6a2d2475cb6c5b7",
         )
 
         self.mocks["check_call"].reset_mock()
         self.harness.update_config({"token": "test-token-2"})
-        self.assertEqual(self.mocks["check_call"].call_count, 3)
-        self.mocks["check_call"].assert_has_calls(
-            self._add_ua_proxy_setup_calls(
-                [call(["ubuntu-advantage", "detach", "--assume-yes"])], append=False
-            )
+        self.mocks["check_call"].assert_called_once_with(
+            ["ubuntu-advantage", "detach", "--assume-yes"]
         )
         assert m_get_status_output.call_count == 4
         assert m_attach_subscription.call_count == 2
         self.assertEqual(
             self.harness.charm._state.hashed_token,
-            "ab8a83efb364bf3f6739348519b53c8e8e0f7b4c06b6eeb881ad73dcf0059107",
+            "b2:dcd58e4532cb553dcbf18a7ad08343ff",
         )
         self.assertEqual(
             self.harness.model.unit.status, ActiveStatus("Attached (esm-apps,esm-infra,livepatch)")
@@ -328,16 +416,13 @@ class TestCharm(TestCase):
         self.harness.update_config({"token": "test-token"})
         self.assertEqual(
             self.harness.charm._state.hashed_token,
-            "4c5dc9b7708905f77f5e5d16316b5dfb425e68cb326dcd55a860e90a7707031e",
+            "b2:2d30173aca15d9b6b6a2d2475cb6c5b7",
         )
 
         self.mocks["check_call"].reset_mock()
         self.harness.update_config({"token": ""})
-        self.assertEqual(self.mocks["check_call"].call_count, 3)
-        self.mocks["check_call"].assert_has_calls(
-            self._add_ua_proxy_setup_calls(
-                [call(["ubuntu-advantage", "detach", "--assume-yes"])], append=False
-            )
+        self.mocks["check_call"].assert_called_once_with(
+            ["ubuntu-advantage", "detach", "--assume-yes"]
         )
         assert m_get_status_output.call_count == 3
         assert m_attach_subscription.call_count == 1
@@ -375,17 +460,53 @@ class TestCharm(TestCase):
         self.harness.update_config({"token": "test-token\n"})
         self.assertEqual(
             self.harness.charm._state.hashed_token,
-            "4c5dc9b7708905f77f5e5d16316b5dfb425e68cb326dcd55a860e90a7707031e",
+            "b2:2d30173aca15d9b6b6a2d2475cb6c5b7",
         )
         assert m_get_status_output.call_count == 2
         assert m_attach_subscription.call_count == 1
 
+    @patch("charm.attach_subscription")
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_ATTACHED))
+    def test_config_changed_legacy_hashed_token(self, m_get_status_output, m_attach_subscription):
+        self.harness.charm._state.contract_url = "https://contracts.canonical.com"
+        self.harness.charm._state.hashed_token = (
+            "4c5dc9b7708905f77f5e5d16316b5dfb425e68cb326dcd55a860e90a7707031e"
+        )
+        self.harness.update_config({"token": "test-token"})
+        self.assertNotIn(
+            call(["ubuntu-advantage", "detach", "--assume-yes"]),
+            self.mocks["check_call"].call_args_list,
+        )
+        m_attach_subscription.assert_not_called()
+        self.assertEqual(
+            self.harness.charm._state.hashed_token, "b2:2d30173aca15d9b6b6a2d2475cb6c5b7"
+        )
+
+    @patch("charm.attach_subscription", side_effect=[(0, "")])
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_ATTACHED))
+    def test_config_changed_legacy_hashed_token_changed(
+        self, m_get_status_output, m_attach_subscription
+    ):
+        self.harness.charm._state.contract_url = "https://contracts.canonical.com"
+        self.harness.charm._state.hashed_token = (
+            "4c5dc9b7708905f77f5e5d16316b5dfb425e68cb326dcd55a860e90a7707031e"
+        )
+        self.harness.update_config({"token": "test-token-2"})
+        self.mocks["check_call"].assert_any_call(["ubuntu-advantage", "detach", "--assume-yes"])
+        m_attach_subscription.assert_called_once_with("test-token-2")
+        self.assertEqual(
+            self.harness.charm._state.hashed_token, "b2:dcd58e4532cb553dcbf18a7ad08343ff"
+        )
+
     @patch("charm.get_status_output", side_effect=[json.loads(STATUS_DETACHED)])
     def test_config_changed_ppa_contains_newline(self, m_get_status_output):
         self.harness.update_config({"ppa": "ppa:ua-client/stable\n"})
         self.mocks["check_call"].assert_has_calls(
             [
-                call(["add-apt-repository", "--yes", "ppa:ua-client/stable"], env=self.env),
+                call(
+                    ["add-apt-repository", "--yes", "--no-update", "ppa:ua-client/stable"],
+                    env=self.env,
+                ),
             ]
         )
         self.assertEqual(self.harness.charm._state.ppa, "ppa:ua-client/stable")
@@ -407,26 +528,66 @@ class TestCharm(TestCase):
             self.harness.model.unit.status, ActiveStatus("Attached (esm-apps,esm-infra,livepatch)")
         )
 
+    @patch("time.sleep", MagicMock())
+    def test_get_status_output_failure(self):
+        self.mocks["run"].return_value = MagicMock(
+            args=["ubuntu-advantage", "status"], returncode=1, stdout="", stderr="error"
+        )
+        with self.assertRaises(ProcessExecutionError) as cm:
+            get_status_output()
+        self.assertEqual(cm.exception.ret_code, 1)
+        self.assertEqual(cm.exception.stderr, "error")
+        self.assertEqual(self.mocks["run"].call_count, 3)
+
     @patch("charm.get_status_output", side_effect=[json.loads(STATUS_DETACHED)])
     def test_config_changed_contract_url(self, m_get_status_output):
         self.harness.update_config({"contract_url": "https://contracts.staging.canonical.com"})
         self.mocks["open"].assert_called_with("/etc/ubuntu-advantage/uaclient.conf", "r+")
-        handle = self.mocks["open"]()
         expected = dedent(
-            """\
-            contract_url: https://contracts.staging.canonical.com
+            """
+            # Ubuntu-Advantage client config file.
+            contract_url: "https://contracts.staging.canonical.com"
             data_dir: /var/lib/ubuntu-advantage
-            log_file: /var/log/ubuntu-advantage.log
             log_level: debug
+            log_file: /var/log/ubuntu-advantage.log
         """
         )
-        self.assertEqual(_written(handle), expected)
-        handle.truncate.assert_called_once()
+        self.assertEqual(self.files[-1].contents, expected)
+        self.files[-1].truncate.assert_called_once()
         assert m_get_status_output.call_count == 1
         self.assertEqual(
             self.harness.charm._state.contract_url, "https://contracts.staging.canonical.com"
         )
 
+    def test_update_configuration_contract_url_unchanged(self):
+        update_configuration("https://contracts.canonical.com")
+        self.files[-1].write.assert_not_called()
+        self.files[-1].truncate.assert_not_called()
+
+    def test_update_configuration_contract_url_missing(self):
+        self._fake_open("data_dir: /var/lib/ubuntu-advantage")
+        update_configuration("https://contracts.staging.canonical.com")
+        expected = dedent(
+            """\
+            data_dir: /var/lib/ubuntu-advantage
+            contract_url: "https://contracts.staging.canonical.com"
+        """
+        )
+        self.assertEqual(self.files[-1].contents, expected)
+        self.files[-1].truncate.assert_called_once()
+
+    def test_update_configuration_contract_url_invalid(self):
+        self._fake_open("contract_url: a: b\ndata_dir: /var/lib/ubuntu-advantage\n")
+        update_configuration("https://contracts.staging.canonical.com")
+        expected = dedent(
+            """\
+            contract_url: "https://contracts.staging.canonical.com"
+            data_dir: /var/lib/ubuntu-advantage
+        """
+        )
+        self.assertEqual(self.files[-1].contents, expected)
+        self.files[-1].truncate.assert_called_once()
+
     @patch("charm.attach_subscription", side_effect=[(0, ""), (0, "")])
     @patch(
         "charm.get_status_output",
@@ -445,24 +606,24 @@ class TestCharm(TestCase):
         self.harness.update_config({"token": "test-token"})
         self.assertEqual(
             self.harness.charm._state.hashed_token,
-            "4c5dc9b7708905f77f5e5d16316b5dfb425e68cb326dcd55a860e90a7707031e",
+            "b2:2d30173aca15d9b6b6a2d2475cb6c5b7",
         )
         self.mocks["check_call"].reset_mock()
         self.mocks["open"].reset_mock()
-        mock_open(self.mocks["open"], read_data=DEFAULT_CLIENT_CONFIG)
+        self._fake_open(DEFAULT_CLIENT_CONFIG)
         self.harness.update_config({"contract_url": "https://contracts.staging.canonical.com"})
         self.mocks["open"].assert_called_with("/etc/ubuntu-advantage/uaclient.conf", "r+")
-        handle = self.mocks["open"]()
         expected = dedent(
-            """\
-            contract_url: https://contracts.staging.canonical.com
+            """
+            # Ubuntu-Advantage client config file.
+            contract_url: "https://contracts.staging.canonical.com"
             data_dir: /var/lib/ubuntu-advantage
-            log_file: /var/log/ubuntu-advantage.log
             log_level: debug
+            log_file: /var/log/ubuntu-advantage.log
         """
         )
-        self.assertEqual(_written(handle), expected)
-        handle.truncate.assert_called_once()
+        self.assertEqual(self.files[-1].contents, expected)
+        self.files[-1].truncate.assert_called_once()
         self.mocks["check_call"].assert_has_calls(
             [call(["ubuntu-advantage", "detach", "--assume-yes"])]
         )
@@ -472,12 +633,31 @@ class TestCharm(TestCase):
 
         self.mocks["check_call"].reset_mock()
         self.mocks["open"].reset_mock()
-        mock_open(self.mocks["open"], read_data=DEFAULT_CLIENT_CONFIG)
+        self._fake_open(DEFAULT_CLIENT_CONFIG)
         self.harness.update_config()
         self.mocks["open"].assert_not_called()
-        assert m_get_status_output.call_count == 6
+        assert m_get_status_output.call_count == 4
         assert m_attach_subscription.call_count == 2
 
+    @patch("charm.attach_subscription", side_effect=[(0, "")])
+    @patch(
+        "charm.get_status_output",
+        side_effect=[json.loads(STATUS_DETACHED), json.loads(STATUS_ATTACHED)],
+    )
+    def test_config_changed_status_reused_within_hook(
+        self, m_get_status_output, m_attach_subscription
+    ):
+        self.harness.update_config({"token": "test-token"})
+        assert m_get_status_output.call_count == 2
+
+        m_get_status_output.side_effect = [json.loads(STATUS_ATTACHED)]
+        self.harness.update_config({"override-http-proxy": TEST_PROXY_URL})
+        assert m_get_status_output.call_count == 3
+        assert m_attach_subscription.call_count == 1
+        self.assertEqual(
+            self.harness.model.unit.status, ActiveStatus("Attached (esm-apps,esm-infra,livepatch)")
+        )
+
     @patch(
         "charm.get_status_output",
         side_effect=[json.loads(STATUS_DETACHED), json.loads(STATUS_ATTACHED)],
@@ -485,36 +665,37 @@ class TestCharm(TestCase):
     def test_config_changed_unset_contract_url(self, m_get_status_output):
         self.harness.update_config({"contract_url": "https://contracts.staging.canonical.com"})
         self.mocks["open"].assert_called_with("/etc/ubuntu-advantage/uaclient.conf", "r+")
-        handle = self.mocks["open"]()
         expected = dedent(
-            """\
-            contract_url: https://contracts.staging.canonical.com
+            """
+            # Ubuntu-Advantage client config file.
+            contract_url: "https://contracts.staging.canonical.com"
             data_dir: /var/lib/ubuntu-advantage
-            log_file: /var/log/ubuntu-advantage.log
             log_level: debug
+            log_file: /var/log/ubuntu-advantage.log
         """
         )
-        self.assertEqual(_written(handle), expected)
-        handle.truncate.assert_called_once()
+        self.assertEqual(self.files[-1].contents, expected)
+        self.files[-1].truncate.assert_called_once()
         self.mocks["call"].assert_not_called()
         self.assertEqual(self.harness.model.unit.status, BlockedStatus("No token configured"))
         self.mocks["open"].reset_mock()
+        self._fake_open(expected)
         self.mocks["call"].reset_mock()
         self.mocks["check_call"].reset_mock()
         self.harness.update_config({"contract_url": "https://contracts.canonical.com"})
         self.mocks["open"].assert_called_with("/etc/ubuntu-advantage/uaclient.conf", "r+")
-        handle = self.mocks["open"]()
         expected = dedent(
-            """\
-            contract_url: https://contracts.canonical.com
+            """
+            # Ubuntu-Advantage client config file.
+            contract_url: "https://contracts.canonical.com"
             data_dir: /var/lib/ubuntu-advantage
-            log_file: /var/log/ubuntu-advantage.log
             log_level: debug
+            log_file: /var/log/ubuntu-advantage.log
         """
         )
         assert m_get_status_output.call_count == 2
-        self.assertEqual(_written(handle), expected)
-        handle.truncate.assert_called_once()
+        self.assertEqual(self.files[-1].contents, expected)
+        self.files[-1].truncate.assert_called_once()
         self.mocks["call"].assert_not_called()
         self.assertEqual(self.harness.model.unit.status, BlockedStatus("No token configured"))
 
@@ -570,6 +751,81 @@ class TestCharm(TestCase):
             ]
         )
 
+    @patch(
+        "charm.get_status_output",
+        side_effect=[
+            json.loads(STATUS_DETACHED),
+            json.loads(STATUS_DETACHED),
+            json.loads(STATUS_DETACHED),
+        ],
+    )
+    def test_config_changed_proxy_unchanged(self, m_get_status_output):
+        self.harness.update_config({"override-http-proxy": TEST_PROXY_URL})
+        self.mocks["check_call"].assert_has_calls(
+            [
+                call(["ubuntu-advantage", "config", "set", f"http_proxy={TEST_PROXY_URL}"]),
+                call(["ubuntu-advantage", "config", "unset", "https_proxy"]),
+            ]
+        )
+        self.mocks["check_call"].reset_mock()
+
+        # Only the changed key is applied.
+        self.harness.update_config({"override-https-proxy": TEST_PROXY_URL})
+        self.mocks["check_call"].assert_called_once_with(
+            ["ubuntu-advantage", "config", "set", f"https_proxy={TEST_PROXY_URL}"]
+        )
+        self.mocks["check_call"].reset_mock()
+
+        # Nothing is applied when the proxy settings are unchanged.
+        self.harness.update_config()
+        self.mocks["check_call"].assert_not_called()
+
+    @patch("charm.attach_subscription", side_effect=[(0, "")])
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_ATTACHED))
+    def test_config_changed_unchanged_config(self, m_get_status_output, m_attach_subscription):
+        self.harness.update_config({"token": "test-token"})
+        self.assertIsInstance(self.harness.model.unit.status, ActiveStatus)
+        m_get_status_output.reset_mock()
+        self.mocks["check_call"].reset_mock()
+        self.mocks["apt"].reset_mock()
+
+        self.harness.update_config({"token": "test-token\n"})
+        m_get_status_output.assert_not_called()
+        self.mocks["check_call"].assert_not_called()
+        self.mocks["apt"].add_package.assert_not_called()
+        self.assertIsInstance(self.harness.model.unit.status, ActiveStatus)
+
+        # The configuration is applied again when the unit is not active.
+        self.harness.charm.unit.status = BlockedStatus("No token configured")
+        self.harness.update_config()
+        m_get_status_output.assert_called_once()
+        self.assertIsInstance(self.harness.model.unit.status, ActiveStatus)
+
+    @patch("charm.attach_subscription", side_effect=[(0, "")])
+    @patch("charm.get_status_output", return_value=json.loads(STATUS_ATTACHED))
+    def test_upgrade_charm(self, m_get_status_output, m_attach_subscription):
+        self.harness.update_config({"token": "test-token"})
+        self.assertIsNotNone(self.harness.charm._state.config_hash)
+        m_get_status_output.reset_mock()
+
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assertIsNone(self.harness.charm._state.config_hash)
+        self.harness.update_config()
+        m_get_status_output.assert_called_once()
+        self.assertIsNotNone(self.harness.charm._state.config_hash)
+        self.assertEqual(
+            self.harness.model.unit.status, ActiveStatus("Attached (esm-apps,esm-infra,livepatch)")
+        )
+
+    @patch("charm.attach_subscription", side_effect=[(0, "")])
+    @patch(
+        "charm.get_status_output",
+        side_effect=[json.loads(STATUS_DETACHED), {"attached": True, "services": None}],
+    )
+    def test_config_changed_no_services(self, m_get_status_output, m_attach_subscription):
+        self.harness.update_config({"token": "test-token"})
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus("Attached ()"))
+
     @patch("charm.get_status_output", side_effect=[json.loads(STATUS_DETACHED)])
     def test_setup_proxy_config(self, m_get_status_output):
         self.harness.update_config(
@@ -597,7 +853,7 @@ class TestCharm(TestCase):
         self.assertEqual(self.harness.charm.env["https_proxy"], TEST_PROXY_URL)
         self.assertEqual(self.harness.charm.env["no_proxy"], TEST_NO_PROXY)
 
-    def _add_ua_proxy_setup_calls(self, call_list, append=True):
+    def _add_ua_proxy_setup_calls(self, call_list):
         """Helper to generate the calls used for UA proxy setup."""
         proxy_calls = []
         if self.env["http_proxy"]:
@@ -646,10 +902,10 @@ class TestCharm(TestCase):
                 )
             )
 
-        return call_list + proxy_calls if append else proxy_calls + call_list
+        return call_list + proxy_calls
 
-    def _assert_apt_calls(self):
+    def _assert_apt_calls(self, update_cache=True):
         """Helper to run the assertions for apt install."""
         self.mocks["apt"].add_package.assert_called_once_with(
-            "ubuntu-advantage-tools", update_cache=True
+            "ubuntu-advantage-tools", update_cache=update_cache
         )
@@ -2,16 +2,15 @@
 # See LICENSE file for licensing details.
 
 import logging
+import random
 import time
 from unittest import TestCase
 from unittest.mock import MagicMock, call, patch
 
-from utils.retry import retry
+from utils.retry import RETRY_SLEEPS, retry
 
 logger = logging.getLogger(__name__)
 
-RETRY_SLEEPS = [1, 2, 3]
-
 
 class TestRetryDecorator(TestCase):
     def test_retry_when_success(self):
@@ -48,3 +47,17 @@ class TestRetryDecorator(TestCase):
         logger.warning.assert_has_calls(
             [call("%s: Retrying %d more times.", "Something went wrong", len(RETRY_SLEEPS) - 1)]
         )
+
+    @patch("time.sleep", MagicMock())
+    @patch("random.uniform", MagicMock(side_effect=lambda low, high: high))
+    def test_retry_sleep_jitter(self):
+        @retry(Exception)
+        def func():
+            raise Exception("Something went wrong")
+
+        with self.assertRaises(Exception):
+            func()
+
+        random.uniform.assert_has_calls([call(0, sleep) for sleep in RETRY_SLEEPS[:-1]])
+        time.sleep.assert_has_calls([call(2 * sleep) for sleep in RETRY_SLEEPS[:-1]])
+        self.assertEqual(time.sleep.call_count, len(RETRY_SLEEPS) - 1)